@@ -18,14 +18,21 @@
 """
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 from typing import Optional
 from urllib.parse import urlparse
+import calendar
 import datetime
+import fnmatch
 import glob
 import importlib
 import json
 import logging
+import mmap
+import multiprocessing
 import os
+import random
 import re
 import shutil
 import subprocess
@@ -42,6 +49,9 @@ f' Error: This script requires Python 3.6 or later. Use `python --version` to ch
 
 
 class UserData:
+    # no per-instance __dict__: there is one of these for every user found in the archive
+    __slots__ = ('user_id', 'handle')
+
     def __init__(self, user_id: str, handle: str):
         if user_id is None:
             raise ValueError('ID "None" is not allowed in UserData.')
@@ -78,11 +88,22 @@ class PathConfig:
         self.file_output_following          = os.path.join(self.dir_output,         'following.txt')
         self.file_output_followers          = os.path.join(self.dir_output,         'followers.txt')
         self.file_download_log              = os.path.join(self.dir_output_media,   'download_log.txt')
+        self.file_download_cache            = os.path.join(self.dir_output_cache,   'download_cache.json')
         self.file_tweet_icon                = os.path.join(self.dir_output_media,   'tweet.ico')
         self.files_input_tweets             = find_files_input_tweets(self.dir_input_data)
+        self.input_media_by_id              = None  # built on first use, see find_input_media_files()
 
         # structured like an actual tweet output file, can be used to compute relative urls to a media file
         self.example_file_output_tweets = self.create_path_for_file_output_tweets(year=2020, month=12)
+        # relative urls from any tweet output file to the media folder and the tweet icon
+        self.rel_url_output_media = rel_url(self.dir_output_media, self.example_file_output_tweets)
+        self.rel_url_tweet_icon = rel_url(self.file_tweet_icon, self.example_file_output_tweets)
+
+    def find_input_media_files(self, tweet_id: str) -> list:
+        """Returns the paths of all files in the input media folder that belong to the tweet with the given id."""
+        if self.input_media_by_id is None:
+            self.input_media_by_id = index_media_files(self.dir_input_media)
+        return [os.path.join(self.dir_input_media, filename) for filename in self.input_media_by_id.get(tweet_id, [])]
 
     def create_path_for_file_output_tweets(self, year, month, format="html", kind="tweets") -> str:
         """Builds the path for a tweet-archive file based on some properties."""
@@ -139,9 +160,10 @@ def import_module(module):
 
 
 def open_and_mkdirs(path_file):
-    """Opens a file for writing. If the parent directory does not exist yet, it is created first."""
+    """Opens a file for writing. If the parent directory does not exist yet, it is created first.
+    Uses a 1 MB buffer, as the output files are written in many small pieces but can be tens of MB in total."""
     mkdirs_for_file(path_file)
-    return open(path_file, 'w', encoding='utf-8')
+    return open(path_file, 'w', encoding='utf-8', buffering=1 << 20)
 
 
 def mkdirs_for_file(path_file):
@@ -156,20 +178,19 @@ def rel_url(media_path, document_path):
     return os.path.relpath(media_path, os.path.split(document_path)[0]).replace("\\", "/")
 
 
-def get_twitter_api_guest_token(session, bearer_token):
-    """Returns a Twitter API guest token for the current session."""
-    guest_token_response = session.post("https://api.twitter.com/1.1/guest/activate.json",
-                                        headers={'authorization': f'Bearer {bearer_token}'},
-                                        timeout=2,
-                                        )
+def get_twitter_api_guest_token(session):
+    """Returns a Twitter API guest token for the current session.
+       Expects the authorization header to be set in session.headers already."""
+    guest_token_response = session.post("https://api.twitter.com/1.1/guest/activate.json", timeout=2)
     guest_token = json.loads(guest_token_response.content)['guest_token']
     if not guest_token:
         raise Exception(f"Failed to retrieve guest token")
     return guest_token
 
 
-def get_twitter_users(session, bearer_token, guest_token, user_ids):
-    """Asks Twitter for all metadata associated with user_ids."""
+def get_twitter_users(session, user_ids):
+    """Asks Twitter for all metadata associated with user_ids.
+       Expects the authorization and guest token headers to be set in session.headers already."""
     users = {}
     while user_ids:
         max_batch = 100
@@ -177,10 +198,7 @@ def get_twitter_users(session, bearer_token, guest_token, user_ids):
         user_ids = user_ids[max_batch:]
         user_id_list = ",".join(user_id_batch)
         query_url = f"https://api.twitter.com/1.1/users/lookup.json?user_id={user_id_list}"
-        response = session.get(query_url,
-                               headers={'authorization': f'Bearer {bearer_token}', 'x-guest-token': guest_token},
-                               timeout=2,
-                               )
+        response = session.get(query_url, timeout=2)
         if not response.status_code == 200:
             raise Exception(f'Failed to get user handle: {response}')
         response_json = json.loads(response.content)
@@ -195,6 +213,7 @@ def lookup_users(user_ids, users):
     filtered_user_ids = [id for id in user_ids if id not in users]
     if not filtered_user_ids:
         # Don't bother opening a session if there's nothing to get
+        print('All user handles are already known from the archive, no need to look them up online.')
         return
     # Account metadata observed at ~2.1KB on average.
     estimated_size = int(2.1 * len(filtered_user_ids))
@@ -206,8 +225,12 @@ def lookup_users(user_ids, users):
     try:
         with requests.Session() as session:
             bearer_token = 'AAAAAAAAAAAAAAAAAAAAANRILgAAAAAAnNwIzUejRCOuH5E6I8xnZz4puTs%3D1Zv7ttfk8LF81IUq16cHjhLTvJu4FA33AGWWjCpTnA'
-            guest_token = get_twitter_api_guest_token(session, bearer_token)
-            retrieved_users = get_twitter_users(session, bearer_token, guest_token, filtered_user_ids)
+            session.headers['authorization'] = f'Bearer {bearer_token}'
+            # retry on server errors, with increasing pauses (or as long as the server asks us to wait)
+            retry = requests.adapters.Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+            session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retry))
+            session.headers['x-guest-token'] = get_twitter_api_guest_token(session)
+            retrieved_users = get_twitter_users(session, filtered_user_ids)
             for user_id, user in retrieved_users.items():
                 if user["screen_name"] is not None:
                     users[user_id] = UserData(user_id=user_id, handle=user["screen_name"])
@@ -219,19 +242,18 @@ def lookup_users(user_ids, users):
 def read_json_from_js_file(filename):
     """Reads the contents of a Twitter-produced .js file into a dictionary."""
     print(f'Parsing {filename}...')
-    with open(filename, 'r', encoding='utf8') as f:
-        data = f.readlines()
-        # if the JSON has no real content, it can happen that the file is only one line long.
-        # in this case, return an empty dict to avoid errors while trying to read non-existing lines.
-        if len(data) <= 1:
-            return {}
-        # convert js file to JSON: replace first line with just '[', squash lines into a single string
-        prefix = '['
-        if '{' in data[0]:
-            prefix += ' {'
-        data =  prefix + ''.join(data[1:])
-        # parse the resulting JSON and return as a dict
-        return json.loads(data)
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}  # an empty file can't be memory-mapped
+        # convert js file to JSON: drop the 'window.YTD.<name>.part0 =' assignment in front of it.
+        # The file is memory-mapped, so that only this part is copied into memory, not the whole file first.
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            data = mapped_file[mapped_file.find(b'=') + 1:]
+    # if the JSON has no real content, return an empty dict to avoid errors while trying to parse it.
+    if not data.strip():
+        return {}
+    # parse the resulting JSON and return as a dict. json.loads() decodes the UTF-8 bytes itself.
+    return json.loads(data)
 
 
 def extract_username(paths: PathConfig):
@@ -240,39 +262,104 @@ def extract_username(paths: PathConfig):
     return account[0]['account']['username']
 
 
+# all the characters at which str.splitlines() splits
+LINE_BREAK_PATTERN = re.compile('[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+
+def join_lines(text: str, separator: str) -> str:
+    """Same as `separator.join(text.splitlines())`, but returns text without splitting it if it has no line breaks,
+    which is the case for most tweets."""
+    if not LINE_BREAK_PATTERN.search(text):
+        return text
+    return separator.join(text.splitlines())
+
+
+def replace_all(text: str, replacements: dict) -> str:
+    """Replaces all occurrences of the keys of `replacements` in text with their values, in a single pass over
+    the text (where keys overlap, the longest one wins). Unlike chained str.replace calls, text that was put in
+    by one replacement is not searched again for the next one."""
+    if len(replacements) == 0:
+        return text
+    if len(replacements) == 1:
+        (old, new), = replacements.items()
+        return text.replace(old, new)
+    pattern = '|'.join(re.escape(old) for old in sorted(replacements, key=len, reverse=True))
+    return re.sub(pattern, lambda match: replacements[match.group(0)], text)
+
+
+def interleave(items, separator: str):
+    """Yields the items with separator between them, so that `f.writelines(interleave(items, separator))` writes
+    the same as `f.write(separator.join(items))` without building the whole string in memory first."""
+    first = True
+    for item in items:
+        if not first:
+            yield separator
+        first = False
+        yield item
+
+
+# Translation table for escape_markdown(): add a backslash before markdown control characters,
+# and a double space before line breaks
+MARKDOWN_ESCAPE_TABLE = str.maketrans({**{char: '\\' + char for char in r"\_*[]()~`>#+-=|{}.!"}, '\n': '  \n'})
+
+
 def escape_markdown(input_text: str) -> str:
     """
     Escape markdown control characters from input text so that the text will not break in rendered markdown.
     (Only use on unformatted text parts that do not yet have any markdown control characters added on purpose!)
     """
-    characters_to_escape: str = r"\_*[]()~`>#+-=|{}.!"
-    output_text: str = ''
-    for char in input_text:
-        if char in characters_to_escape:
-            # add backslash before control char
-            output_text = output_text + "\\" + char
-        elif char == '\n':
-            # add double space before line break
-            output_text = output_text + "  " + char
-        else:
-            output_text = output_text + char
-    return output_text
+    return input_text.translate(MARKDOWN_ESCAPE_TABLE)
+
 
+TWITTER_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+                  'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 
-def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig):
-    """Converts a JSON-format tweet. Returns tuple of timestamp, markdown and HTML."""
+
+def parse_tweet_timestamp(timestamp_str: str) -> int:
+    """Converts a tweet's 'created_at' string (example: Tue Mar 19 14:05:17 +0000 2019) to a Unix timestamp.
+    The format has fixed field widths, so we slice it directly instead of using the much slower strptime."""
+    if len(timestamp_str) == 30 and timestamp_str[20:25] == '+0000' and timestamp_str[4:7] in TWITTER_MONTHS:
+        return calendar.timegm((int(timestamp_str[26:30]), TWITTER_MONTHS[timestamp_str[4:7]],
+                                int(timestamp_str[8:10]), int(timestamp_str[11:13]), int(timestamp_str[14:16]),
+                                int(timestamp_str[17:19]), 0, 0, 0))
+    # not the usual format, e.g. a different UTC offset: let strptime deal with it
+    return int(round(datetime.datetime.strptime(timestamp_str, '%a %b %d %X %z %Y').timestamp()))
+
+
+DM_TIMESTAMP_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(\.\d+)?Z')
+
+
+def parse_dm_timestamp(created_at: str) -> int:
+    """Converts a message's 'createdAt' string (example: 2022-01-27T15:58:52.744Z) to a Unix timestamp,
+    rounded to whole seconds. Like parse_tweet_timestamp, this avoids strptime for the usual format."""
+    match = DM_TIMESTAMP_PATTERN.fullmatch(created_at)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        timestamp = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second), 0, 0, 0))
+        return int(round(timestamp + float(fraction or 0)))
+    # not the usual format: let strptime deal with it
+    return int(round(datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ')
+                     .replace(tzinfo=datetime.timezone.utc).timestamp()))
+
+
+def convert_tweet(tweet, username, paths: PathConfig):
+    """Converts a JSON-format tweet. Returns tuple of timestamp, markdown, HTML, the (filename, URL) tuples
+    of its media files (see download_larger_media) and the user_id:UserData mappings found in the tweet."""
     if 'tweet' in tweet.keys():
         tweet = tweet['tweet']
     timestamp_str = tweet['created_at']
-    timestamp = int(round(datetime.datetime.strptime(timestamp_str, '%a %b %d %X %z %Y').timestamp()))
-    # Example: Tue Mar 19 14:05:17 +0000 2019
+    timestamp = parse_tweet_timestamp(timestamp_str)
     body_markdown = tweet['full_text']
     body_html = tweet['full_text']
     tweet_id_str = tweet['id_str']
+    entities = tweet.get('entities') or {}
+    media_sources = []
+    users = {}
     # for old tweets before embedded t.co redirects were added, ensure the links are
     # added to the urls entities list so that we can build correct links later on.
-    if 'entities' in tweet and 'media' not in tweet['entities'] and len(tweet['entities'].get("urls", [])) == 0:
-        for word in tweet['full_text'].split():
+    if 'media' not in entities and not entities.get('urls'):
+        for word_match in re.finditer(r'\S+', tweet['full_text']):
+            word = word_match.group()
             try:
                 url = urlparse(word)
             except ValueError:
@@ -283,24 +370,54 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
                     netloc_short = url.netloc[4:] if url.netloc.startswith("www.") else url.netloc
                     path_short = url.path if len(url.path + '?' + url.query) < 15 \
                         else (url.path + '?' + url.query)[:15] + '\u2026'
-                    tweet['entities']['urls'].append({
+                    entities.setdefault('urls', []).append({
                         'url': word,
                         'expanded_url': word,
                         'display_url': netloc_short + path_short,
-                        'indices': [tweet['full_text'].index(word), tweet['full_text'].index(word) + len(word)],
+                        'indices': [word_match.start(), word_match.end()],
                     })
-    # replace t.co URLs with their original versions
-    if 'entities' in tweet and 'urls' in tweet['entities']:
-        for url in tweet['entities']['urls']:
-            if 'url' in url and 'expanded_url' in url:
-                expanded_url = url['expanded_url']
-                body_markdown = body_markdown.replace(url['url'], expanded_url)
-                expanded_url_html = f'<a href="{expanded_url}">{expanded_url}</a>'
-                body_html = body_html.replace(url['url'], expanded_url_html)
+    # replace t.co URLs with their original versions, building both bodies in a single pass over the text
+    urls = [url for url in entities.get('urls') or [] if url.get('url') and url.get('expanded_url')]
+    if urls:
+        full_text = tweet['full_text']
+        markdown_parts = []
+        html_parts = []
+        # find where each URL really starts first, so that they can be replaced in order of their position
+        url_spans = []
+        for url in urls:
+            url_start = int(url['indices'][0]) if 'indices' in url else -1
+            if url_start < 0 or not full_text.startswith(url['url'], url_start):
+                # the indices are missing or don't always match full_text (e.g. when it contains '&amp;'),
+                # so search instead
+                url_start = full_text.find(url['url'])
+                if url_start == -1:
+                    continue
+            url_spans.append((url_start, url))
+        url_spans.sort(key=itemgetter(0))
+        # any other occurrences of these URLs in between get expanded as well
+        markdown_replacements = {url['url']: url['expanded_url'] for _, url in url_spans}
+        html_replacements = {old: f'<a href="{new}">{new}</a>' for old, new in markdown_replacements.items()}
+        pos = 0
+        for url_start, url in url_spans:
+            if url_start < pos:
+                # overlaps a URL that was already replaced (e.g. the same URL appears twice): try its next occurrence
+                url_start = full_text.find(url['url'], pos)
+                if url_start == -1:
+                    continue
+            expanded_url = url['expanded_url']
+            text_before = full_text[pos:url_start]
+            markdown_parts += [replace_all(text_before, markdown_replacements), expanded_url]
+            html_parts += [replace_all(text_before, html_replacements), f'<a href="{expanded_url}">{expanded_url}</a>']
+            pos = url_start + len(url['url'])
+        markdown_parts.append(replace_all(full_text[pos:], markdown_replacements))
+        html_parts.append(replace_all(full_text[pos:], html_replacements))
+        body_markdown = ''.join(markdown_parts)
+        body_html = ''.join(html_parts)
     # if the tweet is a reply, construct a header that links the names
     # of the accounts being replied to the tweet being replied to
     header_markdown = ''
     header_html = ''
+    in_reply_to_screen_name = tweet.get('in_reply_to_screen_name')
     if 'in_reply_to_status_id' in tweet:
         # match and remove all occurrences of '@username ' at the start of the body
         replying_to = re.match(r'^(@[0-9A-Za-z_]* )*', body_markdown)[0]
@@ -312,19 +429,19 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
             replying_to = f'@{username}'
         names = replying_to.split()
         # some old tweets lack 'in_reply_to_screen_name': use it if present, otherwise fall back to names[0]
-        in_reply_to_screen_name = tweet['in_reply_to_screen_name'] if 'in_reply_to_screen_name' in tweet else names[0]
+        reply_header_screen_name = in_reply_to_screen_name or names[0]
         # create a list of names of the form '@name1, @name2 and @name3' - or just '@name1' if there is only one name
         name_list = ', '.join(names[:-1]) + (f' and {names[-1]}' if len(names) > 1 else names[0])
         in_reply_to_status_id = tweet['in_reply_to_status_id']
-        replying_to_url = f'https://twitter.com/{in_reply_to_screen_name}/status/{in_reply_to_status_id}'
+        replying_to_url = f'https://twitter.com/{reply_header_screen_name}/status/{in_reply_to_status_id}'
         header_markdown += f'Replying to [{escape_markdown(name_list)}]({replying_to_url})\n\n'
         header_html += f'Replying to <a href="{replying_to_url}">{name_list}</a><br>'
     # escape tweet body for markdown rendering:
     body_markdown = escape_markdown(body_markdown)
     # replace image URLs with image links to local files
-    if 'entities' in tweet and 'media' in tweet['entities'] and 'extended_entities' in tweet \
-            and 'media' in tweet['extended_entities']:
-        original_url = tweet['entities']['media'][0]['url']
+    if 'media' in entities and 'extended_entities' in tweet and 'media' in tweet['extended_entities']:
+        original_url = entities['media'][0]['url']
+        original_url_markdown = escape_markdown(original_url)
         markdown = ''
         html = ''
         for media in tweet['extended_entities']['media']:
@@ -334,13 +451,13 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
                 archive_media_filename = tweet_id_str + '-' + original_filename
                 archive_media_path = os.path.join(paths.dir_input_media, archive_media_filename)
                 file_output_media = os.path.join(paths.dir_output_media, archive_media_filename)
-                media_url = rel_url(file_output_media, paths.example_file_output_tweets)
-                markdown += '' if not markdown and body_markdown == escape_markdown(original_url) else '\n\n'
+                media_url = f'{paths.rel_url_output_media}/{archive_media_filename}'
+                markdown += '' if not markdown and body_markdown == original_url_markdown else '\n\n'
                 html += '' if not html and body_html == original_url else '<br>'
                 if os.path.isfile(archive_media_path):
                     # Found a matching image, use this one
                     if not os.path.isfile(file_output_media):
-                        shutil.copy(archive_media_path, file_output_media)
+                        copy_media_file(archive_media_path, file_output_media)
                     markdown += f'![]({media_url})'
                     html += f'<img src="{media_url}"/>'
                     # Save the online location of the best-quality version of this file, for later upgrading if wanted
@@ -350,14 +467,14 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
                     )
                 else:
                     # Is there any other file that includes the tweet_id in its filename?
-                    archive_media_paths = glob.glob(os.path.join(paths.dir_input_media, tweet_id_str + '*'))
+                    archive_media_paths = paths.find_input_media_files(tweet_id_str)
                     if len(archive_media_paths) > 0:
                         for archive_media_path in archive_media_paths:
                             archive_media_filename = os.path.split(archive_media_path)[-1]
                             file_output_media = os.path.join(paths.dir_output_media, archive_media_filename)
-                            media_url = rel_url(file_output_media, paths.example_file_output_tweets)
+                            media_url = f'{paths.rel_url_output_media}/{archive_media_filename}'
                             if not os.path.isfile(file_output_media):
-                                shutil.copy(archive_media_path, file_output_media)
+                                copy_media_file(archive_media_path, file_output_media)
                             markdown += f'<video controls><source src="{media_url}">Your browser ' \
                                         f'does not support the video tag.</video>\n'
                             html += f'<video controls><source src="{media_url}">Your browser ' \
@@ -365,66 +482,81 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
                             # Save the online location of the best-quality version of this file,
                             # for later upgrading if wanted
                             if 'video_info' in media and 'variants' in media['video_info']:
-                                best_quality_url = ''
-                                best_bitrate = -1 # some valid videos are marked with bitrate=0 in the JSON
-                                for variant in media['video_info']['variants']:
-                                    if 'bitrate' in variant:
-                                        bitrate = int(variant['bitrate'])
-                                        if bitrate > best_bitrate:
-                                            best_quality_url = variant['url']
-                                            best_bitrate = bitrate
-                                if best_bitrate == -1:
+                                # some valid videos are marked with bitrate=0 in the JSON
+                                variants = [variant for variant in media['video_info']['variants']
+                                            if 'bitrate' in variant]
+                                if len(variants) == 0:
                                     print(f"Warning No URL found for {original_url} {original_expanded_url} "
                                           f"{archive_media_path} {media_url}")
                                     print(f"JSON: {tweet}")
                                 else:
+                                    best_variant = max(variants, key=lambda variant: int(variant['bitrate']))
                                     media_sources.append(
                                         (os.path.join(paths.dir_output_media, archive_media_filename),
-                                         best_quality_url)
+                                         best_variant['url'])
                                     )
                     else:
                         print(f'Warning: missing local file: {archive_media_path}. Using original link instead: '
                               f'{original_url} (expands to {original_expanded_url})')
                         markdown += f'![]({original_url})'
                         html += f'<a href="{original_url}">{original_url}</a>'
-        body_markdown = body_markdown.replace(escape_markdown(original_url), markdown)
+        body_markdown = body_markdown.replace(original_url_markdown, markdown)
         body_html = body_html.replace(original_url, html)
-    # make the body a quote
-    body_markdown = '> ' + '\n> '.join(body_markdown.splitlines())
-    body_html = '<p><blockquote>' + '<br>\n'.join(body_html.splitlines()) + '</blockquote>'
-    # append the original Twitter URL as a link
+    # make the body a quote, and append the original Twitter URL as a link.
+    # The pieces are joined in one go, so that the (possibly long) body is only copied once.
     original_tweet_url = f'https://twitter.com/{username}/status/{tweet_id_str}'
-    icon_url = rel_url(paths.file_tweet_icon, paths.example_file_output_tweets) 
-    body_markdown = header_markdown + body_markdown + f'\n\n<img src="{icon_url}" width="12" /> ' \
-                                                      f'[{timestamp_str}]({original_tweet_url})'
-    body_html = header_html + body_html + f'<a href="{original_tweet_url}"><img src="{icon_url}" ' \
-                                          f'width="12" />&nbsp;{timestamp_str}</a></p>'
+    icon_url = paths.rel_url_tweet_icon
+    body_markdown = ''.join([
+        header_markdown, '> ', join_lines(body_markdown, '\n> '),
+        f'\n\n<img src="{icon_url}" width="12" /> [{timestamp_str}]({original_tweet_url})',
+    ])
+    body_html = ''.join([
+        header_html, '<p><blockquote>', join_lines(body_html, '<br>\n'), '</blockquote>',
+        f'<a href="{original_tweet_url}"><img src="{icon_url}" width="12" />&nbsp;{timestamp_str}</a></p>',
+    ])
     # extract user_id:handle connections
-    if 'in_reply_to_user_id' in tweet and 'in_reply_to_screen_name' in tweet and \
-            tweet['in_reply_to_screen_name'] is not None:
-        reply_to_id = tweet['in_reply_to_user_id']
-        if int(reply_to_id) >= 0:  # some ids are -1, not sure why
-            handle = tweet['in_reply_to_screen_name']
-            users[reply_to_id] = UserData(user_id=reply_to_id, handle=handle)
-    if 'entities' in tweet and 'user_mentions' in tweet['entities'] and tweet['entities']['user_mentions'] is not None:
-        for mention in tweet['entities']['user_mentions']:
-            if mention is not None and 'id' in mention and 'screen_name' in mention:
-                mentioned_id = mention['id']
-                if int(mentioned_id) >= 0:  # some ids are -1, not sure why
-                    handle = mention['screen_name']
-                    if handle is not None:
-                        users[mentioned_id] = UserData(user_id=mentioned_id, handle=handle)
-
-    return timestamp, body_markdown, body_html
+    reply_to_id = tweet.get('in_reply_to_user_id')
+    if reply_to_id is not None and in_reply_to_screen_name is not None:
+        if not reply_to_id.startswith('-'):  # some ids are -1, not sure why
+            users[reply_to_id] = UserData(user_id=reply_to_id, handle=in_reply_to_screen_name)
+    for mention in entities.get('user_mentions') or []:
+        if mention is not None:
+            mentioned_id = mention.get('id')
+            handle = mention.get('screen_name')
+            if mentioned_id is not None and handle is not None:
+                if not mentioned_id.startswith('-'):  # some ids are -1, not sure why
+                    users[mentioned_id] = UserData(user_id=mentioned_id, handle=handle)
+
+    return timestamp, body_markdown, body_html, media_sources, users
+
+
+# Arguments for convert_tweet() that are the same for every tweet. Set once per worker process by
+# init_convert_tweet_worker(), so that they don't have to be sent along with every tweet.
+convert_tweet_worker_args = None
+
+
+def init_convert_tweet_worker(username, paths: PathConfig):
+    """Initializes a worker process of the pool used by parse_tweets()."""
+    global convert_tweet_worker_args
+    convert_tweet_worker_args = (username, paths)
+
+
+def convert_tweet_in_worker(tweet):
+    """Runs convert_tweet() in a worker process of the pool used by parse_tweets()."""
+    username, paths = convert_tweet_worker_args
+    return convert_tweet(tweet, username, paths)
 
 
 def find_files_input_tweets(dir_path_input_data):
     """Identify the tweet archive's file and folder names -
     they change slightly depending on the archive size it seems."""
     input_tweets_file_templates = ['tweet.js', 'tweets.js', 'tweets-part*.js']
+    with os.scandir(dir_path_input_data) as entries:
+        file_names = [entry.name for entry in entries if entry.is_file()]
     files_paths_input_tweets = []
     for input_tweets_file_template in input_tweets_file_templates:
-        files_paths_input_tweets += glob.glob(os.path.join(dir_path_input_data, input_tweets_file_template))
+        files_paths_input_tweets += [os.path.join(dir_path_input_data, file_name)
+                                     for file_name in fnmatch.filter(file_names, input_tweets_file_template)]
     if len(files_paths_input_tweets)==0:
         print(f'Error: no files matching {input_tweets_file_templates} in {dir_path_input_data}')
         exit()
@@ -433,9 +565,12 @@ def find_files_input_tweets(dir_path_input_data):
 
 def find_dir_input_media(dir_path_input_data):
     input_media_dir_templates = ['tweet_media', 'tweets_media']
+    with os.scandir(dir_path_input_data) as entries:
+        dir_names = [entry.name for entry in entries if entry.is_dir()]
     input_media_dirs = []
     for input_media_dir_template in input_media_dir_templates:
-        input_media_dirs += glob.glob(os.path.join(dir_path_input_data, input_media_dir_template))
+        input_media_dirs += [os.path.join(dir_path_input_data, dir_name)
+                             for dir_name in fnmatch.filter(dir_names, input_media_dir_template)]
     if len(input_media_dirs) == 0:
         print(f'Error: no folders matching {input_media_dir_templates} in {dir_path_input_data}')
         exit()
@@ -445,23 +580,55 @@ def find_dir_input_media(dir_path_input_data):
     return input_media_dirs[0]
 
 
-def download_file_if_larger(url, filename, index, count, sleep_time):
-    """Attempts to download from the specified URL. Overwrites file if larger.
+def copy_media_file(src, dst):
+    """Makes the archive media file `src` available at `dst`, as a hard link if the file system allows it
+       (no bytes need to be duplicated), otherwise as a copy. Safe because the media files are only ever
+       replaced as a whole (see download_file_if_larger), never written to in place."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def index_media_files(dir_path) -> dict:
+    """Lists the files in a media folder once and groups them by the tweet or message id at the start of
+    their filename (e.g. '1234-abc.jpg' belongs to '1234'), so lookups don't have to scan the folder again."""
+    media_files = defaultdict(list)
+    if os.path.isdir(dir_path):
+        with os.scandir(dir_path) as entries:
+            filenames = sorted(entry.name for entry in entries if entry.is_file())
+        for filename in filenames:
+            media_files[filename.split('-', 1)[0]].append(filename)
+    return media_files
+
+
+def download_file_if_larger(session, url, filename, local_image_sizes, index, count, sleep_time):
+    """Attempts to download from the specified URL, using the given requests session. Overwrites file if larger.
+       `local_image_sizes` caches the pixel size of local files, so that retries don't have to read them again.
        Returns whether the file is now known to be the largest available, and the number of bytes downloaded.
     """
-    requests = import_module('requests')
     imagesize = import_module('imagesize')
 
     pref = f'{index:3d}/{count:3d} {filename}: '
-    # Sleep briefly, in an attempt to minimize the possibility of trigging some auto-cutoff mechanism
+    # Sleep briefly, in an attempt to minimize the possibility of trigging some auto-cutoff mechanism.
+    # The random factor keeps the parallel downloads from hitting the server in lockstep.
     if index > 1:
         print(f'{pref}Sleeping...', end='\r')
-        time.sleep(sleep_time)
-    # Request the URL (in stream mode so that we can conditionally abort depending on the headers)
+        time.sleep(sleep_time * random.random())
     print(f'{pref}Requesting headers for {url}...', end='\r')
     byte_size_before = os.path.getsize(filename)
     try:
-        with requests.get(url, stream=True, timeout=2) as res:
+        # Ask for the headers only: most files turn out to have the same size, and then no body needs to be sent
+        res = session.head(url, timeout=2, allow_redirects=True)
+        if res.status_code == 200 and int(res.headers.get('content-length', -1)) == byte_size_before:
+            logging.info(f'{pref}SKIPPED. Online version is same byte size, assuming same content. Not downloaded.')
+            return True, 0
+    except Exception:
+        # the HEAD request is only a shortcut: if it fails, let the GET request below decide
+        pass
+    try:
+        # Request the URL (in stream mode so that we can conditionally abort depending on the headers)
+        with session.get(url, stream=True, timeout=2) as res:
             if not res.status_code == 200:
                 # Try to get content of response as `res.text`.
                 # For twitter.com, this will be empty in most (all?) cases.
@@ -476,7 +643,10 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                 with open(tmp_filename,'wb') as f:
                     shutil.copyfileobj(res.raw, f)
                 post = f'{byte_size_after/2**20:.1f}MB downloaded'
-                width_before, height_before = imagesize.get(filename)
+                # the local file only changes where it is replaced below, and there its cached size is updated too
+                if filename not in local_image_sizes:
+                    local_image_sizes[filename] = imagesize.get(filename)
+                width_before, height_before = local_image_sizes[filename]
                 width_after, height_after = imagesize.get(tmp_filename)
                 pixels_before, pixels_after = width_before * height_before, width_after * height_after
                 pixels_percentage_increase = 100.0 * (pixels_after - pixels_before) / pixels_before
@@ -484,6 +654,7 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                 if width_before == -1 and height_before == -1 and width_after == -1 and height_after == -1:
                     # could not check size of both versions, probably a video or unsupported image format
                     os.replace(tmp_filename, filename)
+                    local_image_sizes[filename] = (width_after, height_after)
                     bytes_percentage_increase = 100.0 * (byte_size_after - byte_size_before) / byte_size_before
                     logging.info(f'{pref}SUCCESS. New version is {bytes_percentage_increase:3.0f}% '
                                  f'larger in bytes (pixel comparison not possible). {post}')
@@ -495,6 +666,7 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                     return False, byte_size_after
                 elif pixels_after >= pixels_before:
                     os.replace(tmp_filename, filename)
+                    local_image_sizes[filename] = (width_after, height_after)
                     bytes_percentage_increase = 100.0 * (byte_size_after - byte_size_before) / byte_size_before
                     if bytes_percentage_increase >= 0:
                         logging.info(f'{pref}SUCCESS. New version is {bytes_percentage_increase:3.0f}% larger in bytes '
@@ -516,78 +688,188 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
         return False, 0
 
 
+def download_files_if_larger(session, urls, filename, local_image_sizes, index, count, sleep_time):
+    """Tries each of the URLs for the same local file in turn, so that no two threads write to it at once.
+       Returns the URLs that failed, and the number of bytes downloaded.
+    """
+    failed_urls = []
+    total_bytes_downloaded = 0
+    for url in urls:
+        success, bytes_downloaded = \
+            download_file_if_larger(session, url, filename, local_image_sizes, index, count, sleep_time)
+        if not success:
+            failed_urls.append(url)
+        total_bytes_downloaded += bytes_downloaded
+    return failed_urls, total_bytes_downloaded
+
+
+def as_completed_or_cancel(futures):
+    """Like as_completed, but cancels the futures that haven't started yet when the caller stops early (e.g. on
+       Ctrl-C), instead of leaving the executor to work through all of them before it can shut down.
+    """
+    try:
+        yield from as_completed(futures)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
 def download_larger_media(media_sources, paths: PathConfig):
     """Uses (filename, URL) tuples in media_sources to download files from remote storage.
        Aborts downloads if the remote file is the same size or smaller than the existing local version.
        Retries the failed downloads several times, with increasing pauses between each to avoid being blocked.
+       Several files are downloaded in parallel, since the time is spent mostly waiting for the network.
+       Files that were found to be the best-quality version in the last few days are not checked again.
     """
+    requests = import_module('requests')
+    import_module('imagesize')  # import now, so that any question about installing it comes before the threads start
+    max_parallel_downloads = 8
     # Log to file as well as the console
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
     mkdirs_for_file(paths.file_download_log)
     logfile_handler = logging.FileHandler(filename=paths.file_download_log, mode='w')
     logfile_handler.setLevel(logging.INFO)
     logging.getLogger().addHandler(logfile_handler)
-    # Download new versions
+    # Skip the files that an earlier run already found to be the best-quality version available
+    download_cache_max_age = 7 * 24 * 60 * 60  # seconds
+    download_cache = {}
+    if os.path.isfile(paths.file_download_cache):
+        try:
+            with open(paths.file_download_cache, 'r', encoding='utf-8') as f:
+                download_cache = json.load(f)
+            if not isinstance(download_cache, dict):
+                raise ValueError('expected a JSON object')
+        except (ValueError, OSError) as err:
+            print(f'Warning: ignoring unreadable download cache {paths.file_download_cache}: {err}')
+            download_cache = {}
     start_time = time.time()
+    # The same local file can be listed with several URLs (e.g. a photo in a tweet that also has a video),
+    # so group them to be tried one after another
+    urls_by_path = defaultdict(list)
+    for local_media_path, media_url in media_sources:
+        if media_url not in urls_by_path[local_media_path]:
+            urls_by_path[local_media_path].append(media_url)
+    media_sources = []
+    for local_media_path, media_urls in urls_by_path.items():
+        cache_entry = download_cache.get(local_media_path)
+        try:
+            is_cached = cache_entry['urls'] == media_urls \
+                and cache_entry['local_size'] == os.path.getsize(local_media_path) \
+                and start_time - cache_entry['checked'] <= download_cache_max_age
+        except (TypeError, KeyError):
+            # no entry yet, or one that doesn't have the expected shape
+            is_cached = False
+        if not is_cached:
+            media_sources.append((local_media_path, media_urls))
+    if len(media_sources) < len(urls_by_path):
+        logging.info(f'Skipping {len(urls_by_path) - len(media_sources)} media files which were already '
+                     f'found to be the best-quality available in the last {download_cache_max_age // 86400} days.\n')
+    # Download new versions
     total_bytes_downloaded = 0
     sleep_time = 0.25
     remaining_tries = 5
-    while remaining_tries > 0:
-        number_of_files = len(media_sources)
-        success_count = 0
-        retries = []
-        for index, (local_media_path, media_url) in enumerate(media_sources):
-            success, bytes_downloaded = download_file_if_larger(
-                media_url, local_media_path, index + 1, number_of_files, sleep_time
-            )
-            if success:
-                success_count += 1
-            else:
-                retries.append((local_media_path, media_url))
-            total_bytes_downloaded += bytes_downloaded
-
-            # show % done and estimated remaining time:
-            time_elapsed: float = time.time() - start_time
-            estimated_time_per_file: float = time_elapsed / (index + 1)
-            estimated_time_remaining: datetime.datetime = \
-                datetime.datetime.fromtimestamp(
-                    (number_of_files - (index + 1)) * estimated_time_per_file,
-                    tz=datetime.timezone.utc
-                )
-            if estimated_time_remaining.hour >= 1:
-                time_remaining_string: str = \
-                    f"{estimated_time_remaining.hour} hour{'' if estimated_time_remaining.hour == 1 else 's'} " \
-                    f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'}"
-            elif estimated_time_remaining.minute >= 1:
-                time_remaining_string: str = \
-                    f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'} " \
-                    f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
-            else:
-                time_remaining_string: str = \
-                    f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
+    local_image_sizes = {}
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_parallel_downloads) as executor:
+        # keep one open connection per download thread, so that they all get reused instead of reconnecting
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_parallel_downloads)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        while remaining_tries > 0:
+            number_of_files = len(media_sources)
+            success_count = 0
+            retries = []
+            futures = {
+                executor.submit(
+                    download_files_if_larger,
+                    session, media_urls, local_media_path, local_image_sizes, index + 1, number_of_files, sleep_time
+                ): (local_media_path, media_urls)
+                for index, (local_media_path, media_urls) in enumerate(media_sources)
+            }
+            for done_count, future in enumerate(as_completed_or_cancel(futures), start=1):
+                failed_urls, bytes_downloaded = future.result()
+                local_media_path, media_urls = futures[future]
+                if failed_urls:
+                    retries.append((local_media_path, failed_urls))
+                else:
+                    success_count += 1
+                    # the URLs that aren't retried here already succeeded in an earlier try
+                    download_cache[local_media_path] = {
+                        'urls': urls_by_path[local_media_path],
+                        'local_size': os.path.getsize(local_media_path),
+                        'checked': time.time(),
+                    }
+                total_bytes_downloaded += bytes_downloaded
+
+                # show % done and estimated remaining time:
+                time_elapsed: float = time.time() - start_time
+                estimated_time_per_file: float = time_elapsed / done_count
+                estimated_time_remaining: datetime.datetime = \
+                    datetime.datetime.fromtimestamp(
+                        (number_of_files - done_count) * estimated_time_per_file,
+                        tz=datetime.timezone.utc
+                    )
+                if estimated_time_remaining.hour >= 1:
+                    time_remaining_string: str = \
+                        f"{estimated_time_remaining.hour} hour{'' if estimated_time_remaining.hour == 1 else 's'} " \
+                        f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'}"
+                elif estimated_time_remaining.minute >= 1:
+                    time_remaining_string: str = \
+                        f"{estimated_time_remaining.minute} minute" \
+                        f"{'' if estimated_time_remaining.minute == 1 else 's'} " \
+                        f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
+                else:
+                    time_remaining_string: str = \
+                        f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
 
-            if index + 1 == number_of_files:
-                print('    100 % done.')
-            else:
-                print(f'    {(100*(index+1)/number_of_files):.1f} % done, about {time_remaining_string} remaining...')
-
-        media_sources = retries
-        remaining_tries -= 1
-        sleep_time += 2
-        logging.info(f'\n{success_count} of {number_of_files} tested media files '
-                     f'are known to be the best-quality available.\n')
-        if len(retries) == 0:
-            break
-        if remaining_tries > 0:
-            print(f'----------------------\n\nRetrying the ones that failed, with a longer sleep. '
-                  f'{remaining_tries} tries remaining.\n')
+                if done_count == number_of_files:
+                    print('    100 % done.')
+                else:
+                    print(f'    {(100*done_count/number_of_files):.1f} % done, '
+                          f'about {time_remaining_string} remaining...')
+
+            media_sources = retries
+            remaining_tries -= 1
+            sleep_time += 2
+            logging.info(f'\n{success_count} of {number_of_files} tested media files '
+                         f'are known to be the best-quality available.\n')
+            if len(retries) == 0:
+                break
+            if remaining_tries > 0:
+                print(f'----------------------\n\nRetrying the ones that failed, with a longer sleep. '
+                      f'{remaining_tries} tries remaining.\n')
     end_time = time.time()
 
     logging.info(f'Total downloaded: {total_bytes_downloaded/2**20:.1f}MB = {total_bytes_downloaded/2**30:.2f}GB')
     logging.info(f'Time taken: {end_time-start_time:.0f}s')
+    # write to a temporary file first, so that an interrupted run can't leave a truncated cache behind
+    tmp_file_download_cache = paths.file_download_cache + '.tmp'
+    with open_and_mkdirs(tmp_file_download_cache) as f:
+        json.dump(download_cache, f, indent=2)
+    os.replace(tmp_file_download_cache, paths.file_download_cache)
     print(f'Wrote log to {paths.file_download_log}')
 
 
+def group_tweets_by_month(tweets):
+    """Yields ((year, month), tweets of that month) for the (timestamp, ...) tuples in tweets, which have to be sorted
+    by timestamp. Each month's tweets are one run in the sorted list, so they can be written out month by month."""
+    month_key = None
+    month_start_index = 0
+    next_month_start = None
+    for index, tweet in enumerate(tweets):
+        timestamp = tweet[0]
+        # Use a (markdown) filename that can be imported into Jekyll: YYYY-MM-DD-your-title-here.md
+        # The tweets are sorted, so the month only needs to be worked out again once we're past its end
+        if month_key is None or timestamp >= next_month_start:
+            if month_key is not None:
+                yield month_key, tweets[month_start_index:index]
+            dt = datetime.datetime.fromtimestamp(timestamp)
+            month_key = (dt.year, dt.month)
+            month_start_index = index
+            next_month_start = datetime.datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1).timestamp()
+    if month_key is not None:
+        yield month_key, tweets[month_start_index:]
+
+
 def parse_tweets(username, users, html_template, paths: PathConfig):
     """Read tweets from paths.files_input_tweets, write to *.md and *.html.
        Copy the media used to paths.dir_output_media.
@@ -596,31 +878,33 @@ def parse_tweets(username, users, html_template, paths: PathConfig):
    """
     tweets = []
     media_sources = []
-    for tweets_js_filename in paths.files_input_tweets:
-        json = read_json_from_js_file(tweets_js_filename)
-        for tweet in json:
-            tweets.append(convert_tweet(tweet, username, media_sources, users, paths))
-    tweets.sort(key=lambda tup: tup[0]) # oldest first
-
-    # Group tweets by month
-    grouped_tweets = defaultdict(list)
-    for timestamp, md, html in tweets:
-        # Use a (markdown) filename that can be imported into Jekyll: YYYY-MM-DD-your-title-here.md
-        dt = datetime.datetime.fromtimestamp(timestamp)
-        grouped_tweets[(dt.year, dt.month)].append((md, html))
-
-    for (year, month), content in grouped_tweets.items():
+    # converting the tweets is CPU-bound and each tweet is independent, so spread them over all CPU cores
+    with multiprocessing.Pool(initializer=init_convert_tweet_worker, initargs=(username, paths)) as pool:
+        for tweets_js_filename in paths.files_input_tweets:
+            tweets_json = read_json_from_js_file(tweets_js_filename)
+            for timestamp, md, html, tweet_media_sources, tweet_users in \
+                    pool.imap(convert_tweet_in_worker, tweets_json, chunksize=256):
+                tweets.append((timestamp, md, html))
+                media_sources.extend(tweet_media_sources)
+                users.update(tweet_users)
+            # free this part of the archive before parsing the next one, so only one is held in memory at a time
+            del tweets_json
+    tweets.sort(key=itemgetter(0)) # oldest first
+
+    # Write the tweets into one file per month
+    html_header, html_footer = html_template.split('{}')
+    for (year, month), content in group_tweets_by_month(tweets):
         # Write into *.md files
-        md_string = '\n\n----\n\n'.join(md for md, _ in content)
         md_path = paths.create_path_for_file_output_tweets(year, month, format="md")
         with open_and_mkdirs(md_path) as f:
-            f.write(md_string)
+            f.writelines(interleave((md for _, md, _ in content), '\n\n----\n\n'))
 
         # Write into *.html files
-        html_string = '<hr>\n'.join(html for _, html in content)
         html_path = paths.create_path_for_file_output_tweets(year, month, format="html")
         with open_and_mkdirs(html_path) as f:
-            f.write(html_template.format(html_string))
+            f.write(html_header)
+            f.writelines(interleave((html for _, _, html in content), '<hr>\n'))
+            f.write(html_footer)
 
     print(f'Wrote {len(tweets)} tweets to *.md and *.html, '
           f'with images and video embedded from {paths.dir_output_media}')
@@ -628,13 +912,11 @@ def parse_tweets(username, users, html_template, paths: PathConfig):
     return media_sources
 
 
-def collect_user_ids_from_followings(paths) -> list:
+def collect_user_ids_from_followings(following_json) -> list:
     """
-     Collect all user ids that appear in the followings archive data.
+     Collect all user ids that appear in the followings archive data (the content of following.js).
      (For use in bulk online lookup from Twitter.)
     """
-    # read JSON file from archive
-    following_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'following.js'))
     # collect all user ids in a list
     following_ids = []
     for follow in following_json:
@@ -643,15 +925,10 @@ def collect_user_ids_from_followings(paths) -> list:
     return following_ids
 
 
-def parse_followings(users, user_id_url_template, paths: PathConfig):
-    """Parse paths.dir_input_data/following.js, write to paths.file_output_following.
+def parse_followings(following_ids, users, user_id_url_template, paths: PathConfig):
+    """Write the followed accounts (see collect_user_ids_from_followings) to paths.file_output_following.
     """
     following = []
-    following_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'following.js'))
-    following_ids = []
-    for follow in following_json:
-        if 'following' in follow and 'accountId' in follow['following']:
-            following_ids.append(follow['following']['accountId'])
     for following_id in following_ids:
         handle = users[following_id].handle if following_id in users else '~unknown~handle~'
         following.append(handle + ' ' + user_id_url_template.format(following_id))
@@ -662,13 +939,11 @@ def parse_followings(users, user_id_url_template, paths: PathConfig):
     print(f"Wrote {len(following)} accounts to {following_output_path}")
 
 
-def collect_user_ids_from_followers(paths) -> list:
+def collect_user_ids_from_followers(follower_json) -> list:
     """
-     Collect all user ids that appear in the followers archive data.
+     Collect all user ids that appear in the followers archive data (the content of follower.js).
      (For use in bulk online lookup from Twitter.)
     """
-    # read JSON file from archive
-    follower_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'follower.js'))
     # collect all user ids in a list
     follower_ids = []
     for follower in follower_json:
@@ -677,15 +952,10 @@ def collect_user_ids_from_followers(paths) -> list:
     return follower_ids
 
 
-def parse_followers(users, user_id_url_template, paths: PathConfig):
-    """Parse paths.dir_input_data/followers.js, write to paths.file_output_followers.
+def parse_followers(follower_ids, users, user_id_url_template, paths: PathConfig):
+    """Write the followers (see collect_user_ids_from_followers) to paths.file_output_followers.
     """
     followers = []
-    follower_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'follower.js'))
-    follower_ids = []
-    for follower in follower_json:
-        if 'follower' in follower and 'accountId' in follower['follower']:
-            follower_ids.append(follower['follower']['accountId'])
     for follower_id in follower_ids:
         handle = users[follower_id].handle if follower_id in users else '~unknown~handle~'
         followers.append(handle + ' ' + user_id_url_template.format(follower_id))
@@ -702,13 +972,58 @@ def chunks(lst: list, n: int):
         yield lst[i:i + n]
 
 
-def collect_user_ids_from_direct_messages(paths) -> list:
+def write_conversation_files(messages, heading: str, title: str, name: str, kind: str, paths: PathConfig) -> list:
+    """Writes the (timestamp, markdown) tuples in messages to a markdown file for the conversation.
+    If there are more than 1000 messages, the conversation was split up in the twitter archive.
+    Following this standard, longer conversations are also split up in the output files.
+    Returns a (path, number of messages) tuple for each file written."""
+    if len(messages) > 1000:
+        parts = [(chunk_index + 1, chunk) for chunk_index, chunk in enumerate(chunks(messages, 1000))]
+    else:
+        parts = [(None, messages)]
+    written_files = []
+    for index, part in parts:
+        part_title = title if index is None else f'{title}, part {index}'
+        output_path = paths.create_path_for_file_output_dms(name=name, index=index, format="md", kind=kind)
+        with open_and_mkdirs(output_path) as f:
+            f.write(f'{heading}### {part_title}: ###\n\n----\n\n')
+            f.writelines(interleave((md for _, md in part), '\n\n----\n\n'))
+        written_files.append((output_path, len(part)))
+    return written_files
+
+
+def write_conversations(conversations, kind: str, paths: PathConfig):
+    """Writes the (name, heading, title, messages) tuples in conversations with write_conversation_files.
+    The files are written from several threads, as this is mostly waiting for the disk.
+    Returns the number of files and the number of messages written."""
+    num_written_files = 0
+    num_written_messages = 0
+    with ThreadPoolExecutor() as executor:
+        futures = []
+        futures_by_name = {}
+        for name, heading, title, messages in conversations:
+            # conversations with the same name write to the same files, so the earlier one has to finish first.
+            # Compare the names case-insensitively, as they are the same file on Windows and macOS.
+            name_key = name.casefold()
+            if name_key in futures_by_name:
+                futures_by_name[name_key].result()
+            future = executor.submit(write_conversation_files, messages, heading, title, name, kind, paths)
+            futures_by_name[name_key] = future
+            futures.append(future)
+        # report in the original order, independent of which thread finished first
+        for future in futures:
+            for output_path, message_count in future.result():
+                print(f'Wrote {message_count} messages to {output_path}')
+                num_written_files += 1
+                num_written_messages += message_count
+    return num_written_files, num_written_messages
+
+
+def collect_user_ids_from_direct_messages(dms_json) -> list:
     """
-     Collect all user ids that appear in the direct messages archive data.
+     Collect all user ids that appear in the direct messages archive data (the content of direct-messages.js).
      (For use in bulk online lookup from Twitter.)
     """
-    # read JSON file from archive
-    dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages.js'))
     # collect all user ids in a set
     dms_user_ids = set()
     for conversation in dms_json:
@@ -721,11 +1036,24 @@ def collect_user_ids_from_direct_messages(paths) -> list:
     return list(dms_user_ids)
 
 
-def parse_direct_messages(username, users, user_id_url_template, paths: PathConfig):
-    """Parse paths.dir_input_data/direct-messages.js, write to one markdown file per conversation.
+def get_handle_markdown(user_id, users, user_id_url_template, handles_markdown) -> str:
+    """Returns the user's handle escaped for markdown, or a link to the user id if the handle is unknown.
+    The results are cached in `handles_markdown`, as the same few users appear in every message of a conversation."""
+    handle_markdown = handles_markdown.get(user_id)
+    if handle_markdown is None:
+        handle_markdown = escape_markdown(users[user_id].handle) if user_id in users \
+            else user_id_url_template.format(user_id)
+        handles_markdown[user_id] = handle_markdown
+    return handle_markdown
+
+
+def parse_direct_messages(dms_json, username, users, user_id_url_template, paths: PathConfig):
+    """Parse the content of paths.dir_input_data/direct-messages.js, write to one markdown file per conversation.
     """
-    # read JSON file
-    dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages.js'))
+    dir_input_dm_media = os.path.join(paths.dir_input_data, 'direct_messages_media')
+    dm_media_files = index_media_files(dir_input_dm_media)
+    handles_markdown = {}
+    escaped_username = escape_markdown(username)
 
     # Parse the DMs and store the messages in a dict
     conversations_messages = defaultdict(list)
@@ -739,16 +1067,15 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                 for message in dm_conversation['messages']:
                     if 'messageCreate' in message:
                         message_create = message['messageCreate']
-                        if all(tag in message_create for tag in ['senderId', 'recipientId', 'text', 'createdAt']):
+                        if 'senderId' in message_create and 'recipientId' in message_create \
+                                and 'text' in message_create and 'createdAt' in message_create:
                             from_id = message_create['senderId']
                             to_id = message_create['recipientId']
                             body = message_create['text']
                             # replace t.co URLs with their original versions
-                            if 'urls' in message_create and len(message_create['urls']) > 0:
-                                for url in message_create['urls']:
-                                    if 'url' in url and 'expanded' in url:
-                                        expanded_url = url['expanded']
-                                        body = body.replace(url['url'], expanded_url)
+                            if 'urls' in message_create:
+                                body = replace_all(body, {url['url']: url['expanded'] for url in message_create['urls']
+                                                          if url.get('url') and url.get('expanded')})
                             # escape message body for markdown rendering:
                             body_markdown = escape_markdown(body)
                             # replace image URLs with image links to local files
@@ -756,20 +1083,21 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                                     and len(message_create['mediaUrls']) == 1 \
                                     and 'urls' in message_create:
                                 original_expanded_url = message_create['urls'][0]['expanded']
+                                original_expanded_url_markdown = escape_markdown(original_expanded_url)
                                 message_id = message_create['id']
                                 media_hash_and_type = message_create['mediaUrls'][0].split('/')[-1]
                                 media_id = message_create['mediaUrls'][0].split('/')[-2]
                                 archive_media_filename = f'{message_id}-{media_hash_and_type}'
                                 new_url = os.path.join(paths.dir_output_media, archive_media_filename)
-                                archive_media_path = \
-                                    os.path.join(paths.dir_input_data, 'direct_messages_media', archive_media_filename)
-                                if os.path.isfile(archive_media_path):
+                                archive_media_path = os.path.join(dir_input_dm_media, archive_media_filename)
+                                message_media_filenames = dm_media_files.get(message_id, [])
+                                if archive_media_filename in message_media_filenames:
                                     # found a matching image, use this one
                                     if not os.path.isfile(new_url):
-                                        shutil.copy(archive_media_path, new_url)
+                                        copy_media_file(archive_media_path, new_url)
                                     image_markdown = f'\n![]({new_url})\n'
                                     body_markdown = body_markdown.replace(
-                                        escape_markdown(original_expanded_url), image_markdown
+                                        original_expanded_url_markdown, image_markdown
                                     )
 
                                     # Save the online location of the best-quality version of this file,
@@ -791,18 +1119,17 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                                     # )
 
                                 else:
-                                    archive_media_paths = glob.glob(
-                                        os.path.join(paths.dir_input_data, 'direct_messages_media', message_id + '*'))
-                                    if len(archive_media_paths) > 0:
-                                        for archive_media_path in archive_media_paths:
-                                            archive_media_filename = os.path.split(archive_media_path)[-1]
+                                    if len(message_media_filenames) > 0:
+                                        for archive_media_filename in message_media_filenames:
+                                            archive_media_path = \
+                                                os.path.join(dir_input_dm_media, archive_media_filename)
                                             media_url = os.path.join(paths.dir_output_media, archive_media_filename)
                                             if not os.path.isfile(media_url):
-                                                shutil.copy(archive_media_path, media_url)
+                                                copy_media_file(archive_media_path, media_url)
                                             video_markdown = f'\n<video controls><source src="{media_url}">' \
                                                              f'Your browser does not support the video tag.</video>\n'
                                             body_markdown = body_markdown.replace(
-                                                escape_markdown(original_expanded_url), video_markdown
+                                                original_expanded_url_markdown, video_markdown
                                             )
 
                                     # TODO: maybe  also save the online location of the best-quality version for videos?
@@ -813,16 +1140,13 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                                               f'Using original link instead: {original_expanded_url})')
 
                             created_at = message_create['createdAt']  # example: 2022-01-27T15:58:52.744Z
-                            timestamp = \
-                                int(round(datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ').timestamp()))
+                            timestamp = parse_dm_timestamp(created_at)
 
-                            from_handle = escape_markdown(users[from_id].handle) if from_id in users \
-                                else user_id_url_template.format(from_id)
-                            to_handle = escape_markdown(users[to_id].handle) if to_id in users \
-                                else user_id_url_template.format(to_id)
+                            from_handle = get_handle_markdown(from_id, users, user_id_url_template, handles_markdown)
+                            to_handle = get_handle_markdown(to_id, users, user_id_url_template, handles_markdown)
 
                             # make the body a quote
-                            body_markdown = '> ' + '\n> '.join(body_markdown.splitlines())
+                            body_markdown = '> ' + join_lines(body_markdown, '\n> ')
                             message_markdown = f'{from_handle} -> {to_handle}: ({created_at}) \n\n' \
                                                f'{body_markdown}'
                             messages.append((timestamp, message_markdown))
@@ -834,73 +1158,40 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
             conversations_messages[other_user_id].extend(messages)
 
     # output as one file per conversation (or part of long conversation)
-    num_written_messages = 0
-    num_written_files = 0
+    conversations = []
     for other_user_id, messages in conversations_messages.items():
         # sort messages by timestamp
-        messages.sort(key=lambda tup: tup[0])
+        messages.sort(key=itemgetter(0))
 
-        other_user_name = escape_markdown(users[other_user_id].handle) if other_user_id in users \
-            else user_id_url_template.format(other_user_id)
+        other_user_name = get_handle_markdown(other_user_id, users, user_id_url_template, handles_markdown)
 
         other_user_short_name: str = users[other_user_id].handle if other_user_id in users else other_user_id
 
-        escaped_username = escape_markdown(username)
+        conversations.append((other_user_short_name, '',
+                              f'Conversation between {escaped_username} and {other_user_name}', messages))
 
-        # if there are more than 1000 messages, the conversation was split up in the twitter archive.
-        # following this standard, also split up longer conversations in the output files:
-
-        if len(messages) > 1000:
-            for chunk_index, chunk in enumerate(chunks(messages, 1000)):
-                markdown = ''
-                markdown += f'### Conversation between {escaped_username} and {other_user_name}, ' \
-                            f'part {chunk_index+1}: ###\n\n----\n\n'
-                markdown += '\n\n----\n\n'.join(md for _, md in chunk)
-                conversation_output_path = paths.create_path_for_file_output_dms(name=other_user_short_name, index=(chunk_index + 1), format="md")
-
-                # write part to a markdown file
-                with open_and_mkdirs(conversation_output_path) as f:
-                    f.write(markdown)
-                print(f'Wrote {len(chunk)} messages to {conversation_output_path}')
-                num_written_files += 1
-
-        else:
-            markdown = ''
-            markdown += f'### Conversation between {escaped_username} and {other_user_name}: ###\n\n----\n\n'
-            markdown += '\n\n----\n\n'.join(md for _, md in messages)
-            conversation_output_path = paths.create_path_for_file_output_dms(name=other_user_short_name, format="md")
-
-            with open_and_mkdirs(conversation_output_path) as f:
-                f.write(markdown)
-            print(f'Wrote {len(messages)} messages to {conversation_output_path}')
-            num_written_files += 1
-
-        num_written_messages += len(messages)
+    num_written_files, num_written_messages = write_conversations(conversations, 'DMs', paths)
 
     print(f"\nWrote {len(conversations_messages)} direct message conversations "
           f"({num_written_messages} total messages) to {num_written_files} markdown files\n")
 
 
+# Translation table for make_conversation_name_safe_for_filename():
+# 0x00 - 0x1F and 0x7F are forbidden in filenames, just discard them. Replace other unsafe characters with underscores.
+FILENAME_UNSAFE_CHARS_TABLE = str.maketrans({
+    **{chr(code): None for code in range(0x20)},
+    '\x7f': None,
+    **{char: '_' for char in '"\'*/\\:<>?|!@;,=.'},
+})
+
+
 def make_conversation_name_safe_for_filename(conversation_name: str) -> str:
     """
     Remove/replace characters that could be unsafe in filenames
     """
-    forbidden_chars = \
-        ['"', "'", '*', '/', '\\', ':', '<', '>', '?', '|', '!', '@', ';', ',', '=', '.', '\n', '\r', '\t']
-    new_conversation_name = ''
-    for char in conversation_name:
-        if char in forbidden_chars:
-            new_conversation_name = new_conversation_name + '_'
-        elif char.isspace():
-            # replace spaces with underscores
-            new_conversation_name = new_conversation_name + '_'
-        elif char == 0x7F or (0x1F >= ord(char) >= 0x00):
-            # 0x00 - 0x1F and 0x7F are also forbidden, just discard them
-            continue
-        else:
-            new_conversation_name = new_conversation_name + char
-
-    return new_conversation_name
+    # replace spaces (and other whitespace, including line breaks and tabs) with underscores first,
+    # so that the whitespace control characters don't get discarded with the others
+    return re.sub(r'\s', '_', conversation_name).translate(FILENAME_UNSAFE_CHARS_TABLE)
 
 
 def find_group_dm_conversation_participant_ids(conversation: dict) -> set:
@@ -925,13 +1216,12 @@ def find_group_dm_conversation_participant_ids(conversation: dict) -> set:
     return group_user_ids
 
 
-def collect_user_ids_from_group_direct_messages(paths) -> list:
+def collect_user_ids_from_group_direct_messages(group_dms_json) -> list:
     """
-     Collect all user ids that appear in the group direct messages archive data.
+     Collect all user ids that appear in the group direct messages archive data
+     (the content of direct-messages-group.js).
      (For use in bulk online lookup from Twitter.)
     """
-    # read JSON file from archive
-    group_dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages-group.js'))
     # collect all user ids in a set
     group_dms_user_ids = set()
     for conversation in group_dms_json:
@@ -941,11 +1231,13 @@ def collect_user_ids_from_group_direct_messages(paths) -> list:
     return list(group_dms_user_ids)
 
 
-def parse_group_direct_messages(username, users, user_id_url_template, paths):
-    """Parse data_folder/direct-messages-group.js, write to one markdown file per conversation.
+def parse_group_direct_messages(group_dms_json, username, users, user_id_url_template, paths):
+    """Parse the content of data_folder/direct-messages-group.js, write to one markdown file per conversation.
     """
-    # read JSON file from archive
-    group_dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages-group.js'))
+    dir_input_group_dm_media = os.path.join(paths.dir_input_data, 'direct_messages_group_media')
+    group_dm_media_files = index_media_files(dir_input_group_dm_media)
+    handles_markdown = {}
+    escaped_username = escape_markdown(username)
 
     # Parse the group DMs, store messages and metadata in a dict
     group_conversations_messages = defaultdict(list)
@@ -963,29 +1255,28 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                     participant_names.append(user_id_url_template.format(participant_id))
 
             # save names in metadata
-            group_conversations_metadata[conversation_id]['participants'] = participants
-            group_conversations_metadata[conversation_id]['participant_names'] = participant_names
-            group_conversations_metadata[conversation_id]['conversation_names'] = [(0, conversation_id)]
-            group_conversations_metadata[conversation_id]['participant_message_count'] = defaultdict(int)
-            for participant_id in participants:
-                # init every participant's message count with 0, so that users with no activity are not ignored
-                group_conversations_metadata[conversation_id]['participant_message_count'][participant_id] = 0
+            conversation_metadata = group_conversations_metadata[conversation_id]
+            conversation_metadata['participants'] = participants
+            conversation_metadata['participant_names'] = participant_names
+            conversation_names = [(0, conversation_id)]
+            conversation_metadata['conversation_names'] = conversation_names
+            # init every participant's message count with 0, so that users with no activity are not ignored
+            participant_message_count = defaultdict(int, dict.fromkeys(participants, 0))
+            conversation_metadata['participant_message_count'] = participant_message_count
             messages = []
             if 'messages' in dm_conversation:
                 for message in dm_conversation['messages']:
                     if 'messageCreate' in message:
                         message_create = message['messageCreate']
-                        if all(tag in message_create for tag in ['senderId', 'text', 'createdAt']):
+                        if 'senderId' in message_create and 'text' in message_create and 'createdAt' in message_create:
                             from_id = message_create['senderId']
                             # count how many messages this user has sent to the group
-                            group_conversations_metadata[conversation_id]['participant_message_count'][from_id] += 1
+                            participant_message_count[from_id] += 1
                             body = message_create['text']
                             # replace t.co URLs with their original versions
                             if 'urls' in message_create:
-                                for url in message_create['urls']:
-                                    if 'url' in url and 'expanded' in url:
-                                        expanded_url = url['expanded']
-                                        body = body.replace(url['url'], expanded_url)
+                                body = replace_all(body, {url['url']: url['expanded'] for url in message_create['urls']
+                                                          if url.get('url') and url.get('expanded')})
                             # escape message body for markdown rendering:
                             body_markdown = escape_markdown(body)
                             # replace image URLs with image links to local files
@@ -993,21 +1284,21 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                                     and len(message_create['mediaUrls']) == 1 \
                                     and 'urls' in message_create:
                                 original_expanded_url = message_create['urls'][0]['expanded']
+                                original_expanded_url_markdown = escape_markdown(original_expanded_url)
                                 message_id = message_create['id']
                                 media_hash_and_type = message_create['mediaUrls'][0].split('/')[-1]
                                 media_id = message_create['mediaUrls'][0].split('/')[-2]
                                 archive_media_filename = f'{message_id}-{media_hash_and_type}'
                                 new_url = os.path.join(paths.dir_output_media, archive_media_filename)
-                                archive_media_path = \
-                                    os.path.join(paths.dir_input_data, 'direct_messages_group_media',
-                                                 archive_media_filename)
-                                if os.path.isfile(archive_media_path):
+                                archive_media_path = os.path.join(dir_input_group_dm_media, archive_media_filename)
+                                message_media_filenames = group_dm_media_files.get(message_id, [])
+                                if archive_media_filename in message_media_filenames:
                                     # found a matching image, use this one
                                     if not os.path.isfile(new_url):
-                                        shutil.copy(archive_media_path, new_url)
+                                        copy_media_file(archive_media_path, new_url)
                                     image_markdown = f'\n![]({new_url})\n'
                                     body_markdown = body_markdown.replace(
-                                        escape_markdown(original_expanded_url), image_markdown
+                                        original_expanded_url_markdown, image_markdown
                                     )
 
                                     # Save the online location of the best-quality version of this file,
@@ -1029,20 +1320,18 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                                     # )
 
                                 else:
-                                    archive_media_paths = glob.glob(
-                                        os.path.join(paths.dir_input_data, 'direct_messages_group_media',
-                                                     message_id + '*'))
-                                    if len(archive_media_paths) > 0:
-                                        for archive_media_path in archive_media_paths:
-                                            archive_media_filename = os.path.split(archive_media_path)[-1]
+                                    if len(message_media_filenames) > 0:
+                                        for archive_media_filename in message_media_filenames:
+                                            archive_media_path = \
+                                                os.path.join(dir_input_group_dm_media, archive_media_filename)
                                             media_url = os.path.join(paths.dir_output_media,
                                                                      archive_media_filename)
                                             if not os.path.isfile(media_url):
-                                                shutil.copy(archive_media_path, media_url)
+                                                copy_media_file(archive_media_path, media_url)
                                             video_markdown = f'\n<video controls><source src="{media_url}">' \
                                                              f'Your browser does not support the video tag.</video>\n'
                                             body_markdown = body_markdown.replace(
-                                                escape_markdown(original_expanded_url), video_markdown
+                                                original_expanded_url_markdown, video_markdown
                                             )
 
                                     # TODO: maybe  also save the online location of the best-quality version for videos?
@@ -1052,60 +1341,49 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                                         print(f'Warning: missing local file: {archive_media_path}. '
                                               f'Using original link instead: {original_expanded_url})')
                             created_at = message_create['createdAt']  # example: 2022-01-27T15:58:52.744Z
-                            timestamp = int(round(
-                                datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ').timestamp()
-                            ))
-                            from_handle = escape_markdown(users[from_id].handle) if from_id in users \
-                                else user_id_url_template.format(from_id)
+                            timestamp = parse_dm_timestamp(created_at)
+                            from_handle = get_handle_markdown(from_id, users, user_id_url_template, handles_markdown)
                             # make the body a quote
-                            body_markdown = '> ' + '\n> '.join(body_markdown.splitlines())
+                            body_markdown = '> ' + join_lines(body_markdown, '\n> ')
                             message_markdown = f'{from_handle}: ({created_at})\n\n' \
                                                f'{body_markdown}'
                             messages.append((timestamp, message_markdown))
                     elif "conversationNameUpdate" in message:
                         conversation_name_update = message['conversationNameUpdate']
-                        if all(tag in conversation_name_update for tag in ['initiatingUserId', 'name', 'createdAt']):
+                        if 'initiatingUserId' in conversation_name_update and 'name' in conversation_name_update \
+                                and 'createdAt' in conversation_name_update:
                             from_id = conversation_name_update['initiatingUserId']
                             body_markdown = f"_changed group name to: {escape_markdown(conversation_name_update['name'])}_"
                             created_at = conversation_name_update['createdAt']  # example: 2022-01-27T15:58:52.744Z
-                            timestamp = int(round(
-                                datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ').timestamp()
-                            ))
-                            from_handle = escape_markdown(users[from_id].handle) if from_id in users \
-                                else user_id_url_template.format(from_id)
+                            timestamp = parse_dm_timestamp(created_at)
+                            from_handle = get_handle_markdown(from_id, users, user_id_url_template, handles_markdown)
                             message_markdown = f'{from_handle}: ({created_at})\n\n{body_markdown}'
                             messages.append((timestamp, message_markdown))
                             # save metadata about name change:
-                            group_conversations_metadata[conversation_id]['conversation_names'].append(
-                                (timestamp, conversation_name_update['name'])
-                            )
+                            conversation_names.append((timestamp, conversation_name_update['name']))
                     elif "joinConversation" in message:
                         join_conversation = message['joinConversation']
-                        if all(tag in join_conversation for tag in ['initiatingUserId', 'createdAt']):
+                        if 'initiatingUserId' in join_conversation and 'createdAt' in join_conversation:
                             from_id = join_conversation['initiatingUserId']
                             created_at = join_conversation['createdAt']  # example: 2022-01-27T15:58:52.744Z
-                            timestamp = int(round(
-                                datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ').timestamp()
-                            ))
-                            from_handle = escape_markdown(users[from_id].handle) if from_id in users \
-                                else user_id_url_template.format(from_id)
-                            escaped_username = escape_markdown(username)
+                            timestamp = parse_dm_timestamp(created_at)
+                            from_handle = get_handle_markdown(from_id, users, user_id_url_template, handles_markdown)
                             body_markdown = f'_{from_handle} added {escaped_username} to the group_'
                             message_markdown = f'{from_handle}: ({created_at})\n\n{body_markdown}'
                             messages.append((timestamp, message_markdown))
                     elif "participantsJoin" in message:
                         participants_join = message['participantsJoin']
-                        if all(tag in participants_join for tag in ['initiatingUserId', 'userIds', 'createdAt']):
+                        if 'initiatingUserId' in participants_join and 'userIds' in participants_join \
+                                and 'createdAt' in participants_join:
                             from_id = participants_join['initiatingUserId']
                             created_at = participants_join['createdAt']  # example: 2022-01-27T15:58:52.744Z
-                            timestamp = int(round(
-                                datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ').timestamp()
-                            ))
-                            from_handle = escape_markdown(users[from_id].handle) if from_id in users \
-                                else user_id_url_template.format(from_id)
+                            timestamp = parse_dm_timestamp(created_at)
+                            from_handle = get_handle_markdown(from_id, users, user_id_url_template, handles_markdown)
                             joined_ids = participants_join['userIds']
-                            joined_handles = [escape_markdown(users[joined_id].handle) if joined_id in users
-                                              else user_id_url_template.format(joined_id) for joined_id in joined_ids]
+                            joined_handles = [
+                                get_handle_markdown(joined_id, users, user_id_url_template, handles_markdown)
+                                for joined_id in joined_ids
+                            ]
                             name_list = ', '.join(joined_handles[:-1]) + \
                                         (f' and {joined_handles[-1]}' if len(joined_handles) > 1 else
                                          joined_handles[0])
@@ -1114,14 +1392,14 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                             messages.append((timestamp, message_markdown))
                     elif "participantsLeave" in message:
                         participants_leave = message['participantsLeave']
-                        if all(tag in participants_leave for tag in ['userIds', 'createdAt']):
+                        if 'userIds' in participants_leave and 'createdAt' in participants_leave:
                             created_at = participants_leave['createdAt']  # example: 2022-01-27T15:58:52.744Z
-                            timestamp = int(round(
-                                datetime.datetime.strptime(created_at, '%Y-%m-%dT%X.%fZ').timestamp()
-                            ))
+                            timestamp = parse_dm_timestamp(created_at)
                             left_ids = participants_leave['userIds']
-                            left_handles = [escape_markdown(users[left_id].handle) if left_id in users
-                                            else user_id_url_template.format(left_id) for left_id in left_ids]
+                            left_handles = [
+                                get_handle_markdown(left_id, users, user_id_url_template, handles_markdown)
+                                for left_id in left_ids
+                            ]
                             name_list = ', '.join(left_handles[:-1]) + \
                                         (f' and {left_handles[-1]}' if len(left_handles) > 1 else
                                          left_handles[0])
@@ -1133,11 +1411,10 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
             group_conversations_messages[conversation_id].extend(messages)
 
     # output as one file per conversation (or part of long conversation)
-    num_written_messages = 0
-    num_written_files = 0
+    conversations = []
     for conversation_id, messages in group_conversations_messages.items():
         # sort messages by timestamp
-        messages.sort(key=lambda tup: tup[0])
+        messages.sort(key=itemgetter(0))
         # create conversation name for use in filename:
         # first, try to find an official name in the parsed conversation data
 
@@ -1147,8 +1424,10 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
         # and that would probably need a cookie). So there are many groups that do actually have a name,
         # but it can't be used here because we don't know it.
 
-        group_conversations_metadata[conversation_id]['conversation_names'].sort(key=lambda tup: tup[0], reverse=True)
-        official_name = group_conversations_metadata[conversation_id]['conversation_names'][0][1]
+        conversation_metadata = group_conversations_metadata[conversation_id]
+        participant_count = len(conversation_metadata['participants'])
+        conversation_metadata['conversation_names'].sort(key=itemgetter(0), reverse=True)
+        official_name = conversation_metadata['conversation_names'][0][1]
         safe_group_name = make_conversation_name_safe_for_filename(official_name)
         if len(safe_group_name) < 2:
             # discard name if it's too short (because of collision risk)
@@ -1159,25 +1438,21 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
         if group_name == conversation_id:
             # try to make a nice list of participant handles for the conversation name
             handles = []
-            for participant_id, message_count in \
-                    group_conversations_metadata[conversation_id]['participant_message_count'].items():
+            for participant_id, message_count in conversation_metadata['participant_message_count'].items():
                 if participant_id in users:
                     participant_handle = users[participant_id].handle
                     if participant_handle != username:
                         handles.append((participant_handle, message_count))
             # sort alphabetically by handle first, for a more deterministic order
-            handles.sort(key=lambda tup: tup[0])
+            handles.sort(key=itemgetter(0))
             # sort so that the most active users are at the start of the list
-            handles.sort(key=lambda tup: tup[1], reverse=True)
+            handles.sort(key=itemgetter(1), reverse=True)
             if len(handles) == 1:
-                group_name = \
-                    f'{handles[0][0]}_and_{len(group_conversations_metadata[conversation_id]["participants"]) - 1}_more'
-            elif len(handles) == 2 and len(group_conversations_metadata[conversation_id]["participants"]) == 3:
+                group_name = f'{handles[0][0]}_and_{participant_count - 1}_more'
+            elif len(handles) == 2 and participant_count == 3:
                 group_name = f'{handles[0][0]}_and_{handles[1][0]}_and_{username}'
             elif len(handles) >= 2:
-                group_name = \
-                    f'{handles[0][0]}_and_{handles[1][0]}_and' \
-                    f'_{len(group_conversations_metadata[conversation_id]["participants"]) - 2}_more'
+                group_name = f'{handles[0][0]}_and_{handles[1][0]}_and_{participant_count - 2}_more'
             else:
                 # just use the conversation id
                 group_name = conversation_id
@@ -1186,42 +1461,17 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
         # to use as a headline in the output file
         escaped_participant_names = [
             escape_markdown(participant_name)
-            for participant_name in group_conversations_metadata[conversation_id]['participant_names']
+            for participant_name in conversation_metadata['participant_names']
         ]
         name_list = ', '.join(escaped_participant_names[:-1]) + \
                     (f' and {escaped_participant_names[-1]}'
                      if len(escaped_participant_names) > 1
                      else escaped_participant_names[0])
 
-        if len(messages) > 1000:
-            for chunk_index, chunk in enumerate(chunks(messages, 1000)):
-                markdown = ''
-                markdown += f'## {official_name} ##\n\n'
-                markdown += f'### Group conversation between {name_list}, part {chunk_index + 1}: ###\n\n----\n\n'
-                markdown += '\n\n----\n\n'.join(md for _, md in chunk)
-                conversation_output_filename = paths.create_path_for_file_output_dms(
-                    name=group_name, format="md", kind="DMs-Group", index=chunk_index + 1
-                )
-                
-                # write part to a markdown file
-                with open_and_mkdirs(conversation_output_filename) as f:
-                    f.write(markdown)
-                print(f'Wrote {len(chunk)} messages to {conversation_output_filename}')
-                num_written_files += 1
-        else:
-            markdown = ''
-            markdown += f'## {official_name} ##\n\n'
-            markdown += f'### Group conversation between {name_list}: ###\n\n----\n\n'
-            markdown += '\n\n----\n\n'.join(md for _, md in messages)
-            conversation_output_filename = \
-                paths.create_path_for_file_output_dms(name=group_name, format="md", kind="DMs-Group")
-
-            with open_and_mkdirs(conversation_output_filename) as f:
-                f.write(markdown)
-            print(f'Wrote {len(messages)} messages to {conversation_output_filename}')
-            num_written_files += 1
+        conversations.append((group_name, f'## {official_name} ##\n\n',
+                              f'Group conversation between {name_list}', messages))
 
-        num_written_messages += len(messages)
+    num_written_files, num_written_messages = write_conversations(conversations, 'DMs-Group', paths)
 
     print(f"\nWrote {len(group_conversations_messages)} direct message group conversations "
           f"({num_written_messages} total messages) to {num_written_files} markdown files")
@@ -1263,11 +1513,15 @@ def migrate_old_output(paths: PathConfig):
         "followers.txt",
         "following.txt",
     ]
+    # list the archive root only once, and match the names against all the patterns
+    # (like glob, leave out hidden files)
+    with os.scandir(paths.dir_archive) as entries:
+        archive_root_names = [entry.name for entry in entries if not entry.name.startswith('.')]
     files_to_delete = []
-    
     for output_glob in output_globs:
-        files_to_delete += glob.glob(os.path.join(paths.dir_archive, output_glob))
-        
+        files_to_delete += [os.path.join(paths.dir_archive, name)
+                            for name in fnmatch.filter(archive_root_names, output_glob)]
+
     # TODO maybe remove those files only after the new ones have been generated? This way, the user would never
     # end up with less output than before. On the other hand, they might end up with old *and* new versions
     # of the output, if the script crashes before it reaches the code to delete the old version.
@@ -1358,29 +1612,33 @@ def main():
 
     media_sources = parse_tweets(username, users, html_template, paths)
 
-    following_ids = collect_user_ids_from_followings(paths)
+    # read the JSON files only once, they are needed both for collecting user ids and for the output
+    following_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'following.js'))
+    follower_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'follower.js'))
+    dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages.js'))
+    group_dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages-group.js'))
+
+    following_ids = collect_user_ids_from_followings(following_json)
     print(f'found {len(following_ids)} user IDs in followings.')
-    follower_ids = collect_user_ids_from_followers(paths)
+    follower_ids = collect_user_ids_from_followers(follower_json)
     print(f'found {len(follower_ids)} user IDs in followers.')
-    dms_user_ids = collect_user_ids_from_direct_messages(paths)
+    dms_user_ids = collect_user_ids_from_direct_messages(dms_json)
     print(f'found {len(dms_user_ids)} user IDs in direct messages.')
-    group_dms_user_ids = collect_user_ids_from_group_direct_messages(paths)
+    group_dms_user_ids = collect_user_ids_from_group_direct_messages(group_dms_json)
     print(f'found {len(group_dms_user_ids)} user IDs in group direct messages.')
 
     # bulk lookup for user handles from followers, followings, direct messages and group direct messages
-    collected_user_ids_without_followers = list(
-        set(following_ids).union(set(dms_user_ids)).union(set(group_dms_user_ids))
-    )
-    collected_user_ids_only_in_followers: set = set(follower_ids).difference(set(collected_user_ids_without_followers))
-    collected_user_ids: list = list(set(collected_user_ids_without_followers)
-                                    .union(collected_user_ids_only_in_followers))
+    collected_user_ids_without_followers: set = set(following_ids)
+    collected_user_ids_without_followers.update(dms_user_ids, group_dms_user_ids)
+    collected_user_ids_only_in_followers: set = set(follower_ids) - collected_user_ids_without_followers
+    collected_user_ids: set = collected_user_ids_without_followers | collected_user_ids_only_in_followers
 
     print(f'\nfound {len(collected_user_ids)} user IDs overall.')
 
     # give the user a choice if followers should be included in the lookup
     # (but only in case they make up a large amount):
-    unknown_collected_user_ids: set = set(collected_user_ids).difference(users.keys())
-    unknown_follower_user_ids: set = unknown_collected_user_ids.intersection(collected_user_ids_only_in_followers)
+    unknown_collected_user_ids: set = collected_user_ids - users.keys()
+    unknown_follower_user_ids: set = unknown_collected_user_ids & collected_user_ids_only_in_followers
     if len(unknown_follower_user_ids) > 5000:
         # Account metadata observed at ~2.1KB on average.
         estimated_follower_lookup_size = int(2.1 * len(unknown_follower_user_ids))
@@ -1401,10 +1659,10 @@ def main():
 
     lookup_users(collected_user_ids, users)
 
-    parse_followings(users, user_id_url_template, paths)
-    parse_followers(users, user_id_url_template, paths)
-    parse_direct_messages(username, users, user_id_url_template, paths)
-    parse_group_direct_messages(username, users, user_id_url_template, paths)
+    parse_followings(following_ids, users, user_id_url_template, paths)
+    parse_followers(follower_ids, users, user_id_url_template, paths)
+    parse_direct_messages(dms_json, username, users, user_id_url_template, paths)
+    parse_group_direct_messages(group_dms_json, username, users, user_id_url_template, paths)
 
     # Download larger images, if the user agrees
     print(f"\nThe archive doesn't contain the original-size images. We can attempt to download them from twimg.com.")